@@ -368,6 +368,11 @@ config = mlc.ConfigDict(
                     "batch_size": 1,
                     "num_workers": 16,
                     "pin_memory": True,
+                    # Only used when num_workers > 0. train_openfold.py 
+                    # rebuilds the dataloaders every epoch, so persistent 
+                    # workers would never be reused
+                    "persistent_workers": False,
+                    "prefetch_factor": 2,
                 },
             },
         },
@@ -381,6 +386,10 @@ config = mlc.ConfigDict(
             # Use FlashAttention in selected modules. Mutually exclusive with 
             # use_lma. Doesn't work that well on long sequences (>1000 residues).
             "use_flash": False,
+            # Compile the training forward pass with torch.compile 
+            # (PyTorch >= 2.0). Recompiles once per recycling depth sampled; 
+            # validation always runs eagerly
+            "use_torch_compile": False,
             "offload_inference": False,
             "c_z": c_z,
             "c_m": c_m,
@@ -622,6 +631,8 @@ config = mlc.ConfigDict(
                 "use_openmm": False, 
                 "weight": 0.01,
                 "add_struct_metrics": True,
+                # 0 restricts structure metrics to validation
+                "struct_metrics_every_n_train_steps": 0,
                 "write_pdbs_every_n_steps": 10,
                 "pdb_dir": "./pdbs",
                 "scale_by_length": False,
@@ -633,6 +644,11 @@ config = mlc.ConfigDict(
                 "add_relu": True,
             },
         },
-        "ema": {"decay": 0.999},
+        "ema": {
+            "decay": 0.999,
+            # Number of training steps between EMA updates. The per-step
+            # decay is compounded accordingly.
+            "update_every": 16,
+        },
     }
 )
@@ -701,14 +701,22 @@ class OpenFoldDataModule(pl.LightningDataModule):
 
         batch_collator = OpenFoldBatchCollator()
 
+        loader_config = self.config.data_module.data_loaders
+        worker_kwargs = {}
+        if(loader_config.num_workers > 0):
+            worker_kwargs["persistent_workers"] = loader_config.persistent_workers
+            worker_kwargs["prefetch_factor"] = loader_config.prefetch_factor
+
         dl = OpenFoldDataLoader(
             dataset,
             config=self.config,
             stage=stage,
             generator=generator,
-            batch_size=self.config.data_module.data_loaders.batch_size,
-            num_workers=self.config.data_module.data_loaders.num_workers,
+            batch_size=loader_config.batch_size,
+            num_workers=loader_config.num_workers,
+            pin_memory=loader_config.pin_memory,
             collate_fn=batch_collator,
+            **worker_kwargs,
         )
 
         return dl
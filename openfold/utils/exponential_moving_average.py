@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 import copy
 import torch
 import torch.nn as nn
@@ -16,9 +17,11 @@ class ExponentialMovingAverage:
         `copy = decay * copy + (1 - decay) * param`
 
     where `decay` is an attribute of the ExponentialMovingAverage object.
+    If updates are only applied every `update_every` steps, `decay` is
+    raised to that power to preserve the effective averaging window.
     """
 
-    def __init__(self, model: nn.Module, decay: float):
+    def __init__(self, model: nn.Module, decay: float, update_every: int = 1):
         """
         Args:
             model:
@@ -26,28 +29,53 @@ class ExponentialMovingAverage:
             decay:
                 A value (usually close to 1.) by which updates are
                 weighted as part of the above formula
+            update_every:
+                The number of training steps between calls to update()
         """
         super(ExponentialMovingAverage, self).__init__()
 
         clone_param = lambda t: t.clone().detach()
         self.params = tensor_tree_map(clone_param, model.state_dict())
         self.decay = decay
+        self.update_every = update_every
         self.device = next(model.parameters()).device
 
     def to(self, device):
         self.params = tensor_tree_map(lambda t: t.to(device), self.params)
         self.device = device
 
+    def _gather_pairs(self, update, state_dict, stored_list, update_list):
+        for k, v in update.items():
+            stored = state_dict[k]
+            if not isinstance(v, torch.Tensor):
+                self._gather_pairs(v, stored, stored_list, update_list)
+            else:
+                stored_list.append(stored)
+                update_list.append(v)
+
     def _update_state_dict_(self, update, state_dict):
+        stored_list, update_list = [], []
+        self._gather_pairs(update, state_dict, stored_list, update_list)
+
+        # The multi-tensor kernels only take their fused path when every
+        # tensor they're given shares a dtype and device, so the pairs are
+        # grouped accordingly. Where the stored copy and the live tensor
+        # differ in dtype (e.g. an fp32 average of bf16 parameters), 
+        # _foreach_add_ still falls back to one kernel per tensor.
+        groups = {}
+        for stored, u in zip(stored_list, update_list):
+            key = (stored.dtype, stored.device, u.dtype, u.device)
+            group = groups.setdefault(key, ([], []))
+            group[0].append(stored)
+            group[1].append(u)
+
+        decay = self.decay ** self.update_every
         with torch.no_grad():
-            for k, v in update.items():
-                stored = state_dict[k]
-                if not isinstance(v, torch.Tensor):
-                    self._update_state_dict_(v, stored)
-                else:
-                    diff = stored - v
-                    diff *= 1 - self.decay
-                    stored -= diff
+            for stored_group, update_group in groups.values():
+                torch._foreach_mul_(stored_group, decay)
+                torch._foreach_add_(
+                    stored_group, update_group, alpha=1 - decay
+                )
 
     def update(self, model: torch.nn.Module) -> None:
         """
@@ -57,9 +85,51 @@ class ExponentialMovingAverage:
         """
         self._update_state_dict_(model.state_dict(), self.params)
 
+    @contextmanager
+    def swapped_into(self, model: torch.nn.Module):
+        """
+        Context manager that temporarily replaces the parameters of the
+        provided module with the stored averages. Buffers are left 
+        untouched.
+
+        Where a parameter and its stored copy share a dtype and device, 
+        their storage is exchanged without copying. Otherwise (e.g. bf16 
+        parameters and an fp32 average) the average is copied into the 
+        parameter, which keeps its own dtype and device, and the live 
+        values are restored on exit from a backup that only lives as long 
+        as the context.
+        """
+        swapped = []
+        copied = []
+        for name, p in model.named_parameters():
+            stored = self.params[name]
+            if(p.dtype == stored.dtype and p.device == stored.device):
+                swapped.append((p, stored))
+            else:
+                copied.append((p, stored))
+
+        def swap():
+            for p, stored in swapped:
+                p.data, stored.data = stored.data, p.data
+
+        with torch.no_grad():
+            swap()
+            backups = [p.detach().clone() for p, _ in copied]
+            for p, stored in copied:
+                p.data.copy_(stored)
+        try:
+            yield
+        finally:
+            with torch.no_grad():
+                swap()
+                for (p, _), backup in zip(copied, backups):
+                    p.data = backup
+
     def load_state_dict(self, state_dict: OrderedDict) -> None:
+        # Loaded tensors may live on any device, so they're placed on the
+        # current one to keep self.device accurate
         for k in state_dict["params"].keys():
-            self.params[k] = state_dict["params"][k].clone()
+            self.params[k] = state_dict["params"][k].to(self.device, copy=True)
         self.decay = state_dict["decay"]
 
     def state_dict(self) -> OrderedDict:
@@ -13,7 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
 from functools import partial
+import io
 import logging
 import os
 import ml_collections
@@ -1530,13 +1532,24 @@ def masked_msa_loss(logits, true_msa, bert_mask, eps=1e-8, **kwargs):
 
 class AlphaFoldLoss(nn.Module):
     """Aggregation of the various losses described in the supplement"""
-    def __init__(self, config, openmm_scheduler, use_wandb=False, mode='train'):
+    def __init__(
+        self, 
+        config, 
+        openmm_scheduler, 
+        use_wandb=False, 
+        mode='train', 
+        pdb_executor=None,
+    ):
         super(AlphaFoldLoss, self).__init__()
         self.config = config
         self.struct_idx = 0
         self._openmm_scheduler = openmm_scheduler
         self.mode = mode
         self.use_wandb = use_wandb
+        # Optional concurrent.futures.Executor used to write PDBs off the
+        # training thread
+        self.pdb_executor = pdb_executor
+        self._pending_pdb_writes = deque()
 
     def forward(self, out, batch, _return_breakdown=False):
         if "violation" not in out.keys():
@@ -1616,9 +1629,9 @@ class AlphaFoldLoss(nn.Module):
                 weight = weight * openmm_lr_modifier
                 try:
                     loss, raw_energy = self._compute_openmm_loss_and_write_pdbs(loss_fn)
-                    losses["openmm_unscaled"] = loss.detach().clone()
-                    losses["openmm_scaled"] = loss.detach().clone() * weight
-                    losses["openmm_raw_energy"] = raw_energy.detach().clone()
+                    losses["openmm_unscaled"] = loss.detach()
+                    losses["openmm_scaled"] = loss.detach() * weight
+                    losses["openmm_raw_energy"] = raw_energy.detach()
                     loss = loss * weight
                 except Exception as e:
                     logging.warning(f"OpenMM loss failed with exception: {e}")
@@ -1639,9 +1652,9 @@ class AlphaFoldLoss(nn.Module):
                 logging.warning(f"{loss_name} loss is NaN. Skipping...")
                 loss = loss.new_tensor(0., requires_grad=True)
             cum_loss = cum_loss + weight * loss
-            losses[loss_name] = loss.detach().clone()
+            losses[loss_name] = loss.detach()
 
-        losses["unscaled_loss"] = cum_loss.detach().clone()
+        losses["unscaled_loss"] = cum_loss.detach()
 
         # Scale the loss by the square root of the minimum of the crop size and
         # the (average) sequence length. See subsection 1.9.
@@ -1649,7 +1662,7 @@ class AlphaFoldLoss(nn.Module):
         crop_len = batch["aatype"].shape[-1]
         cum_loss = cum_loss * torch.sqrt(min(seq_len, crop_len))
 
-        losses["loss"] = cum_loss.detach().clone()
+        losses["loss"] = cum_loss.detach()
 
         if(not _return_breakdown):
             return cum_loss
@@ -1659,6 +1672,9 @@ class AlphaFoldLoss(nn.Module):
     def _compute_openmm_loss_and_write_pdbs(self, loss_fn):
         """Compute OpenMM loss and write out structures to PDBs if requested.
 
+        The {mode}/true and {mode}/pred subdirectories of config.openmm.pdb_dir are
+        expected to exist already; train_openfold.py creates them once per node.
+
         Args:
             loss_fn: A function that computes the OpenMM loss when called.
 
@@ -1669,10 +1685,6 @@ class AlphaFoldLoss(nn.Module):
 
         """
         current_mode = self.mode
-        os.makedirs(os.path.join(self.config.openmm.pdb_dir, current_mode, "true"),
-                    exist_ok=True)
-        os.makedirs(os.path.join(self.config.openmm.pdb_dir, current_mode, "pred"),
-                    exist_ok=True)
 
         loss, scn_proteins_pred, scn_proteins_true, raw_energy = loss_fn()
         if (self.config['openmm']['write_pdbs_every_n_steps'] != -1 and
@@ -1688,19 +1700,69 @@ class AlphaFoldLoss(nn.Module):
                     self.config.openmm.pdb_dir,
                     f"{current_mode}/pred/pred_{self.struct_idx:04d}" +
                     f"_{scn_proteins_true[0].id}.pdb")
-                scn_proteins_true[0].to_pdb(true_fn)
-                scn_proteins_pred[0].to_pdb(pred_fn)
+                # Render the PDBs here so that nothing handed to the executor
+                # references model tensors
+                try:
+                    true_pdb = scn_proteins_true[0].to_pdbstr()
+                    pred_pdb = scn_proteins_pred[0].to_pdbstr()
+                except Exception as e:
+                    logging.warning(f"Rendering PDBs failed with exception: {e}")
+                else:
+                    self._write_pdb(true_fn, true_pdb)
+                    self._write_pdb(pred_fn, pred_pdb)
+                    # Log structures to wandb if enabled. This stays on the
+                    # training thread so that they are attached to the current step.
+                    if self.use_wandb:
+                        wandb.log({"structures/train/true": wandb.Molecule(
+                            io.StringIO(true_pdb), file_type="pdb")}, commit=False)
+                        wandb.log({"structures/train/pred": wandb.Molecule(
+                            io.StringIO(pred_pdb), file_type="pdb")}, commit=False)
                 self.struct_idx += 1
-                # Log structures to wandb if enabled
-                if self.use_wandb:
-                    wandb.log({"structures/train/true": wandb.Molecule(true_fn)},
-                              commit=False)
-                    wandb.log({"structures/train/pred": wandb.Molecule(pred_fn)},
-                              commit=False)
-                    base_path = os.path.split(self.config.openmm.pdb_dir)[0]
-                    wandb.save(true_fn, base_path=base_path)
-                    wandb.save(pred_fn, base_path=base_path)
         elif self.config['openmm']['write_pdbs_every_n_steps'] != -1:
             self.struct_idx += 1
 
         return loss, raw_energy
+
+    def _write_pdb(self, path, pdb_str, max_pending=8):
+        """Write a PDB string to path, in the background if an executor is set.
+
+        At most max_pending writes are queued at a time; beyond that, this waits for
+        the oldest one to finish. If wandb is enabled, the file is saved to the run
+        once it has been written, since wandb.save only picks up existing files.
+        """
+        if self.pdb_executor is None:
+            if _write_pdb_str(path, pdb_str):
+                self._save_pdb_to_wandb(path)
+            return
+
+        pending = self._pending_pdb_writes
+        while len(pending) and pending[0].done():
+            pending.popleft()
+        if len(pending) >= max_pending:
+            pending.popleft().result()
+
+        # Runs on the writer thread once the file exists
+        def on_written(future):
+            if future.result():
+                self._save_pdb_to_wandb(path)
+
+        future = self.pdb_executor.submit(_write_pdb_str, path, pdb_str)
+        future.add_done_callback(on_written)
+        pending.append(future)
+
+    def _save_pdb_to_wandb(self, path):
+        if self.use_wandb:
+            base_path = os.path.split(self.config.openmm.pdb_dir)[0]
+            wandb.save(path, base_path=base_path)
+
+
+def _write_pdb_str(path, pdb_str):
+    """Write a PDB string to disk. May run on a background thread, so failures are
+    logged rather than raised. Returns whether the write succeeded."""
+    try:
+        with open(path, "w") as fp:
+            fp.write(pdb_str)
+    except Exception as e:
+        logging.warning(f"Writing PDB {path} failed with exception: {e}")
+        return False
+    return True
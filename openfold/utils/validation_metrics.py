@@ -11,26 +11,38 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import List, Optional
+
 import torch
 
 
-def drmsd(structure_1, structure_2, mask=None):
-    def prep_d(structure):
-        d = structure[..., :, None, :] - structure[..., None, :, :]
-        d = d ** 2
-        d = torch.sqrt(torch.sum(d, dim=-1))
-        return d
+def _pairwise_distances(structure: torch.Tensor) -> torch.Tensor:
+    d = structure[..., :, None, :] - structure[..., None, :, :]
+    d = d ** 2
+    d = torch.sqrt(torch.sum(d, dim=-1))
+    return d
+
 
-    d1 = prep_d(structure_1)
-    d2 = prep_d(structure_2)
+def drmsd(
+    structure_1: torch.Tensor, 
+    structure_2: torch.Tensor, 
+    mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    d1 = _pairwise_distances(structure_1)
+    d2 = _pairwise_distances(structure_2)
 
     drmsd = d1 - d2
     drmsd = drmsd ** 2
     if(mask is not None):
         drmsd = drmsd * (mask[..., None] * mask[..., None, :])
-    drmsd = torch.sum(drmsd, dim=(-1, -2))
-    n = d1.shape[-1] if mask is None else torch.min(torch.sum(mask, dim=-1))
-    drmsd = drmsd * (1 / (n * (n - 1))) if n > 1 else (drmsd * 0.)
+        n = float(torch.min(torch.sum(mask, dim=-1)))
+    else:
+        n = float(d1.shape[-1])
+    drmsd = torch.sum(drmsd, dim=[-1, -2])
+    if(n > 1):
+        drmsd = drmsd * (1 / (n * (n - 1)))
+    else:
+        drmsd = drmsd * 0.
     drmsd = torch.sqrt(drmsd)
 
     return drmsd
@@ -45,7 +57,12 @@ def drmsd_np(structure_1, structure_2, mask=None):
     return drmsd(structure_1, structure_2, mask)
 
 
-def gdt(p1, p2, mask, cutoffs):
+def gdt(
+    p1: torch.Tensor, 
+    p2: torch.Tensor, 
+    mask: torch.Tensor, 
+    cutoffs: List[float],
+) -> torch.Tensor:
     n = torch.sum(mask, dim=-1)
     
     p1 = p1.float()
@@ -57,13 +74,136 @@ def gdt(p1, p2, mask, cutoffs):
         score = torch.mean(score)
         scores.append(score)
 
-    return sum(scores) / len(scores)
+    return torch.mean(torch.stack(scores))
 
 
-def gdt_ts(p1, p2, mask):
+def gdt_ts(p1: torch.Tensor, p2: torch.Tensor, mask: torch.Tensor):
     return gdt(p1, p2, mask, [1., 2., 4., 8.])
 
 
-def gdt_ha(p1, p2, mask):
+def gdt_ha(p1: torch.Tensor, p2: torch.Tensor, mask: torch.Tensor):
     return gdt(p1, p2, mask, [0.5, 1., 2., 4.])
 
+
+def gdc_all(p1: torch.Tensor, p2: torch.Tensor, mask: torch.Tensor):
+    return gdt(p1, p2, mask, [0.5 * i for i in range(1, 21)])
+
+
+def tm_score(
+    p1: torch.Tensor, 
+    p2: torch.Tensor, 
+    mask: torch.Tensor,
+) -> torch.Tensor:
+    """
+        TM-score of pre-superimposed coordinates. As in 
+        openfold.utils.loss.compute_tm, the number of positions is clipped to 
+        19 to keep d0 positive.
+
+        Args:
+            p1:
+                [*, N, 3] superimposed coordinates
+            p2:
+                [*, N, 3] reference coordinates
+            mask:
+                [*, N] mask
+        Returns:
+            [] TM-score averaged over the batch
+    """
+    n = torch.sum(mask, dim=-1)
+    clipped_n = torch.clamp(n, min=19)
+    d0 = 1.24 * (clipped_n - 15) ** (1.0 / 3) - 1.8
+
+    p1 = p1.float()
+    p2 = p2.float()
+    distances = torch.sqrt(torch.sum((p1 - p2)**2, dim=-1))
+    score = mask / (1 + (distances / d0[..., None]) ** 2)
+    score = torch.sum(score, dim=-1) / n
+
+    return torch.mean(score)
+
+
+def _cdist(x1: torch.Tensor, x2: torch.Tensor) -> torch.Tensor:
+    # The default matmul-based expansion loses ~1e-2 A of precision on 
+    # short distances between atoms far from the origin, which is on the 
+    # order of the lDDT thresholds
+    return torch.cdist(x1, x2, compute_mode="donot_use_mm_for_euclid_dist")
+
+
+def lddt_all(
+    pred_positions,
+    gt_positions,
+    residue_index,
+    cutoff=15.,
+    eps=1e-10,
+    chunk_size=256,
+):
+    """
+        All-atom lDDT. Unlike openfold.utils.loss.lddt, atom pairs belonging 
+        to the same residue are excluded. Distances are computed in blocks of 
+        chunk_size rows, so the full [N, N] distance matrices are never 
+        materialized.
+
+        Args:
+            pred_positions:
+                [N, 3] predicted coordinates of the resolved atoms
+            gt_positions:
+                [N, 3] ground truth coordinates
+            residue_index:
+                [N] index of the residue each atom belongs to
+            cutoff:
+                Inclusion radius in the ground truth structure
+        Returns:
+            [] lDDT averaged over all atoms
+    """
+    pred_positions = pred_positions.float()
+    gt_positions = gt_positions.float()
+    n = gt_positions.shape[-2]
+    
+    total = gt_positions.new_zeros(())
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        d_gt = _cdist(gt_positions[start:end], gt_positions)
+        d_pred = _cdist(pred_positions[start:end], pred_positions)
+
+        dists_to_score = (
+            (d_gt < cutoff) *
+            (residue_index[start:end, None] != residue_index[None, :])
+        )
+
+        dist_l1 = torch.abs(d_gt - d_pred)
+        score = (
+            (dist_l1 < 0.5).float() +
+            (dist_l1 < 1.0).float() +
+            (dist_l1 < 2.0).float() +
+            (dist_l1 < 4.0).float()
+        )
+        score = score * 0.25
+
+        norm = 1. / (eps + torch.sum(dists_to_score, dim=-1))
+        score = norm * (eps + torch.sum(dists_to_score * score, dim=-1))
+        total = total + torch.sum(score)
+
+    return total / max(n, 1)
+
+
+def drmsd_all(pred_positions, gt_positions, chunk_size=256):
+    """
+        Distance-matrix RMSD over all pairs of the [N, 3] inputs, computed in 
+        blocks of chunk_size rows like lddt_all.
+    """
+    pred_positions = pred_positions.float()
+    gt_positions = gt_positions.float()
+    n = gt_positions.shape[-2]
+
+    total = gt_positions.new_zeros(())
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        d_gt = _cdist(gt_positions[start:end], gt_positions)
+        d_pred = _cdist(pred_positions[start:end], pred_positions)
+        total = total + torch.sum((d_gt - d_pred) ** 2)
+
+    # Each pair is visited twice; the diagonal contributes nothing
+    if(n < 2):
+        return total * 0.
+
+    return torch.sqrt(total / (n * (n - 1)))
@@ -24,6 +24,7 @@ from openfold.utils.rigid_utils import (
     rot_to_quat,
 )
 from openfold.utils.chunk_utils import chunk_layer, _chunk_slice
+from openfold.utils.exponential_moving_average import ExponentialMovingAverage
 import tests.compare_utils as compare_utils
 from tests.config import consts
 
@@ -221,6 +222,72 @@ class TestUtils(unittest.TestCase):
 
                 self.assertTrue(torch.all(chunked == chunked_flattened))
 
+    def test_ema_update(self):
+        decay = 0.9
+        model = torch.nn.Linear(4, 4)
+        ema = ExponentialMovingAverage(model, decay=decay)
+        old = {k: v.clone() for k, v in model.state_dict().items()}
+
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+
+        ema.update(model)
+
+        for k, v in model.state_dict().items():
+            expected = decay * old[k] + (1 - decay) * v
+            self.assertTrue(
+                torch.max(torch.abs(ema.params[k] - expected)) < consts.eps
+            )
+
+    def test_ema_load_state_dict_device(self):
+        model = torch.nn.Linear(4, 4)
+        ema = ExponentialMovingAverage(model, decay=0.9)
+        state_dict = ema.state_dict()
+        ema.to(torch.device("meta"))
+
+        ema.load_state_dict(state_dict)
+
+        for v in ema.params.values():
+            self.assertEqual(v.device, ema.device)
+
+    def _check_ema_swap_round_trip(self, model, ema):
+        live = {k: v.clone() for k, v in model.named_parameters()}
+        dtypes = {k: v.dtype for k, v in model.named_parameters()}
+        stored = {k: v.clone() for k, v in ema.params.items()}
+
+        with ema.swapped_into(model):
+            for k, p in model.named_parameters():
+                self.assertEqual(p.dtype, dtypes[k])
+                self.assertTrue(
+                    torch.max(torch.abs(p - stored[k].to(p.dtype))) < consts.eps
+                )
+
+        for k, p in model.named_parameters():
+            self.assertEqual(p.dtype, dtypes[k])
+            self.assertTrue(torch.all(p == live[k]))
+        for k, v in ema.params.items():
+            self.assertTrue(torch.all(v == stored[k]))
+
+    def test_ema_swap_round_trip(self):
+        model = torch.nn.Linear(4, 4)
+        ema = ExponentialMovingAverage(model, decay=0.9)
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+
+        self._check_ema_swap_round_trip(model, ema)
+
+    def test_ema_swap_round_trip_dtype_mismatch(self):
+        model = torch.nn.Linear(4, 4)
+        ema = ExponentialMovingAverage(model, decay=0.9)
+        model.double()
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+
+        self._check_ema_swap_round_trip(model, ema)
+
     @compare_utils.skip_unless_alphafold_installed()
     def test_pre_compose_compare(self):
         quat = np.random.rand(20, 4)
@@ -0,0 +1,127 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import unittest
+
+from openfold.utils.validation_metrics import (
+    drmsd,
+    drmsd_all,
+    gdc_all,
+    gdt_ts,
+    lddt_all,
+    tm_score,
+)
+from tests.config import consts
+
+
+class TestValidationMetrics(unittest.TestCase):
+    def test_lddt_all_chunking(self):
+        n = 50
+        gt = torch.rand((n, 3)) * 20
+        pred = gt + torch.randn((n, 3))
+        residue_index = torch.arange(n) // 5
+
+        chunked = lddt_all(pred, gt, residue_index, chunk_size=7)
+        unchunked = lddt_all(pred, gt, residue_index, chunk_size=n)
+
+        self.assertTrue(torch.abs(chunked - unchunked) < consts.eps)
+
+    def test_lddt_all_identical(self):
+        n = 20
+        gt = torch.rand((n, 3)) * 10
+        residue_index = torch.arange(n) // 4
+
+        self.assertTrue(
+            torch.abs(lddt_all(gt, gt, residue_index) - 1.) < consts.eps
+        )
+
+    def test_lddt_all_far_from_origin(self):
+        n = 60
+        gt = torch.rand((n, 3)) * 20 + 1000.
+        pred = gt + torch.randn((n, 3)) * 0.5
+        residue_index = torch.arange(n) // 5
+
+        def pairwise(x):
+            return torch.sqrt(
+                torch.sum((x[:, None, :] - x[None, :, :]) ** 2, dim=-1)
+            )
+
+        d_gt = pairwise(gt)
+        d_pred = pairwise(pred)
+        to_score = (
+            (d_gt < 15.) * 
+            (residue_index[:, None] != residue_index[None, :])
+        ).float()
+        l1 = torch.abs(d_gt - d_pred)
+        score = 0.25 * sum((l1 < t).float() for t in [0.5, 1., 2., 4.])
+        eps = 1e-10
+        expected = torch.mean(
+            (eps + torch.sum(to_score * score, dim=-1)) / 
+            (eps + torch.sum(to_score, dim=-1))
+        )
+
+        out = lddt_all(pred, gt, residue_index, chunk_size=16)
+
+        self.assertTrue(torch.abs(out - expected) < consts.eps)
+
+    def test_drmsd_all_far_from_origin(self):
+        n = 60
+        gt = torch.rand((n, 3)) * 20 + 1000.
+        pred = gt + torch.randn((n, 3))
+
+        out = drmsd_all(pred, gt, chunk_size=16)
+        gt_drmsd = drmsd(pred, gt)
+
+        self.assertTrue(torch.abs(out - gt_drmsd) < consts.eps)
+
+    def test_drmsd_all_compare(self):
+        n = 50
+        gt = torch.rand((n, 3)) * 20
+        pred = gt + torch.randn((n, 3))
+
+        out = drmsd_all(pred, gt, chunk_size=7)
+        gt_drmsd = drmsd(pred, gt)
+
+        self.assertTrue(torch.abs(out - gt_drmsd) < consts.eps)
+
+    def test_tm_score_gdc_all_identical(self):
+        gt = torch.rand((2, 30, 3)) * 20
+        mask = torch.ones((2, 30))
+        mask[:, -5:] = 0.
+
+        self.assertTrue(torch.abs(tm_score(gt, gt, mask) - 1.) < consts.eps)
+        self.assertTrue(torch.abs(gdc_all(gt, gt, mask) - 1.) < consts.eps)
+
+    def test_metrics_scriptable(self):
+        n = 20
+        gt = torch.rand((n, 3)) * 20
+        pred = gt + torch.randn((n, 3))
+        mask = torch.randint(0, 2, (n,)).float()
+        mask[:2] = 1.
+
+        for fn, args in [
+            (drmsd, (pred, gt, mask)),
+            (gdt_ts, (pred, gt, mask)),
+            (gdc_all, (pred, gt, mask)),
+            (tm_score, (pred, gt, mask)),
+        ]:
+            scripted = torch.jit.script(fn)
+            self.assertTrue(
+                torch.abs(scripted(*args) - fn(*args)) < consts.eps
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,20 @@
 #! /usr/bin/env python
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import importlib.metadata
 import logging
 import os
 import random
-import sys
 import time
 
-import numpy as np
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks.lr_monitor import LearningRateMonitor
 from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
 from pytorch_lightning.plugins.training_type import DeepSpeedPlugin, DDPPlugin
 from pytorch_lightning.plugins.environments import SLURMEnvironment
+from pytorch_lightning.utilities import rank_zero_only
 import torch
 
 from openfold.config import model_config
@@ -35,8 +37,12 @@ from openfold.utils.superimposition import superimpose
 from openfold.utils.tensor_utils import tensor_tree_map
 from openfold.utils.validation_metrics import (
     drmsd,
+    drmsd_all,
+    lddt_all,
+    gdc_all,
     gdt_ts,
     gdt_ha,
+    tm_score,
 )
 from openfold.utils.import_weights import (
     import_jax_weights_,
@@ -48,12 +54,61 @@ from scripts.zero_to_fp32 import (
 
 from openfold.utils.logger import PerformanceLoggingCallback
 
-import sidechainnet.examples.losses as scn_losses
 from sidechainnet.research.openfold.openfold_loss import OpenMMLR
 
 
+# Ground truth coordinate and frame features that the AlphaFoldLoss terms 
+# (fape_loss, supervised_chi_loss, distogram_loss, lddt_loss, tm_loss and 
+# compute_renamed_ground_truth) and the validation metrics read repeatedly. 
+# Keep this in sync with the batch keys read in openfold/utils/loss.py. 
+# Masks are left as views.
+CONTIGUOUS_GT_KEYS = frozenset([
+    "all_atom_positions",
+    "backbone_rigid_tensor",
+    "rigidgroups_gt_frames",
+    "rigidgroups_alt_gt_frames",
+    "atom14_gt_positions",
+    "atom14_alt_gt_positions",
+    "chi_angles_sin_cos",
+    "pseudo_beta",
+])
+
+
+def _remove_recycling_dim(batch):
+    """
+    Selects the final recycling iteration of each feature. The slice is a 
+    strided view; the ground truth features in CONTIGUOUS_GT_KEYS are made 
+    contiguous once here, everything else is left as a view.
+    """
+    batch = tensor_tree_map(lambda t: t[..., -1], batch)
+    for k in CONTIGUOUS_GT_KEYS:
+        if(k in batch):
+            batch[k] = batch[k].contiguous()
+
+    return batch
+
+
+def script_validation_metrics_():
+    """
+    Replaces the tensor-only validation metrics used by OpenFoldWrapper 
+    with TorchScript-compiled versions. superimpose and lddt_ca go through 
+    numpy and Python-level lookups respectively and are left as is.
+    """
+    global drmsd, gdt_ts, gdt_ha, gdc_all, tm_score
+    drmsd = torch.jit.script(drmsd)
+    gdt_ts = torch.jit.script(gdt_ts)
+    gdt_ha = torch.jit.script(gdt_ha)
+    gdc_all = torch.jit.script(gdc_all)
+    tm_score = torch.jit.script(tm_score)
+
+
 class OpenFoldWrapper(pl.LightningModule):
-    def __init__(self, config, use_wandb=False, log_other_metrics_on_step=False):
+    def __init__(self, 
+        config, 
+        use_wandb=False, 
+        log_other_metrics_on_step=False,
+        pdb_executor=None,
+    ):
         super(OpenFoldWrapper, self).__init__()
         self.config = config
         if config.loss.openmm.use_openmm_warmup:
@@ -61,66 +116,120 @@ class OpenFoldWrapper(pl.LightningModule):
         else:
             self.openmm_scheduler = None
         self.model = AlphaFold(config)
-        self.loss = AlphaFoldLoss(config.loss, self.openmm_scheduler, use_wandb=use_wandb)
+        # Compiled forward pass, used for training steps only. Validation runs
+        # eagerly: its batches aren't cropped, and it swaps the EMA weights in
+        # by replacing parameter storage, which compiled code captured during
+        # training must not see.
+        self._compiled_forward = None
+        if(config.globals.use_torch_compile):
+            if(not hasattr(torch, "compile")):
+                raise ValueError("use_torch_compile requires PyTorch 2.0 or later")
+            # Compiling the bound method leaves parameter names, and with them
+            # the EMA and checkpoint keys, unchanged. Training batches have a
+            # fixed crop size, but the number of recycling iterations is
+            # sampled per batch, so expect one recompilation per recycling
+            # depth seen. The default mode is used because CUDA graphs would
+            # pin parameter storage.
+            self._compiled_forward = torch.compile(
+                self.model.forward, 
+                dynamic=False, 
+                fullgraph=False,
+            )
+        self.loss = AlphaFoldLoss(
+            config.loss, 
+            self.openmm_scheduler, 
+            use_wandb=use_wandb,
+            pdb_executor=pdb_executor,
+        )
         self.ema = ExponentialMovingAverage(
-            model=self.model, decay=config.ema.decay
+            model=self.model, 
+            decay=config.ema.decay,
+            update_every=config.ema.update_every,
         )
         
-        self.cached_weights = None
+        # Holds the EMA weights in the model for the length of a validation 
+        # epoch, so that they're swapped in and out once rather than per batch
+        self._ema_swap = None
         self.last_lr_step = -1
 
         self.phase = None
         self.log_other_metrics_on_step = log_other_metrics_on_step
 
+    def on_fit_start(self):
+        # By now the model has been moved to its device. Checkpointed EMA 
+        # weights may be restored before or after this hook (after, with 
+        # DeepSpeed); see on_load_checkpoint
+        self.ema.to(self.device)
+
     def forward(self, batch):
+        if(self.training and self._compiled_forward is not None):
+            return self._compiled_forward(batch)
         return self.model(batch)
 
     def _log(self, loss_breakdown, batch, outputs, train=True):
         phase = self.phase
+
+        # Metrics are grouped by their (on_step, on_epoch) setting and logged
+        # with one log_dict call per group
+        step_metrics = {}
+        epoch_metrics = {}
         for loss_name, indiv_loss in loss_breakdown.items():
-            self.log(
-                f"{phase}/{loss_name}", 
-                indiv_loss, 
-                on_step=train, on_epoch=(not train), logger=True,
-            )
+            # Never hand Lightning a tensor that's still part of the graph
+            if(torch.is_tensor(indiv_loss)):
+                indiv_loss = indiv_loss.detach()
 
             if(train):
-                self.log(
-                    f"{phase}/{loss_name}_epoch",
-                    indiv_loss,
-                    on_step=False, on_epoch=True, logger=True,
-                )
+                step_metrics[f"{phase}/{loss_name}"] = indiv_loss
+                epoch_metrics[f"{phase}/{loss_name}_epoch"] = indiv_loss
+            else:
+                epoch_metrics[f"{phase}/{loss_name}"] = indiv_loss
+
+        # Structure metrics are CPU-bound, so during training they are only
+        # computed every struct_metrics_every_n_train_steps steps (0 = never)
+        openmm_config = self.config.loss.openmm
+        n = openmm_config.struct_metrics_every_n_train_steps
+        superimposition_metrics = not train or (
+            openmm_config.add_struct_metrics and 
+            n > 0 and 
+            self.global_step % n == 0
+        )
 
         with torch.no_grad():
             other_metrics = self._compute_validation_metrics(
                 batch, 
                 outputs,
-                superimposition_metrics=(
-                    not train or self.config.loss.openmm.add_struct_metrics)
+                superimposition_metrics=superimposition_metrics,
             )
 
+        step_and_epoch_metrics = {}
         for k,v in other_metrics.items():
-            try:
-                mean = torch.mean(v)
-            except TypeError:
-                # Structure metrics can be numpy arrays
-                mean = np.mean(v)
-            self.log(
-                f"{phase}/{k}",
-                mean,
-                on_step=self.log_other_metrics_on_step, on_epoch=True, logger=True
+            mean = torch.mean(v)
+            if(self.log_other_metrics_on_step):
+                step_and_epoch_metrics[f"{phase}/{k}"] = mean
+            else:
+                epoch_metrics[f"{phase}/{k}"] = mean
+
+        if(len(step_metrics) > 0):
+            self.log_dict(
+                step_metrics, on_step=True, on_epoch=False, logger=True
+            )
+        if(len(epoch_metrics) > 0):
+            self.log_dict(
+                epoch_metrics, on_step=False, on_epoch=True, logger=True
+            )
+        if(len(step_and_epoch_metrics) > 0):
+            self.log_dict(
+                step_and_epoch_metrics, on_step=True, on_epoch=True, logger=True
             )
 
     def training_step(self, batch, batch_idx):
         self.phase = self.loss.mode = "train"
-        if(self.ema.device != batch["aatype"].device):
-            self.ema.to(batch["aatype"].device)
 
         # Run the model
         outputs = self(batch)
 
         # Remove the recycling dimension
-        batch = tensor_tree_map(lambda t: t[..., -1], batch)
+        batch = _remove_recycling_dim(batch)
 
         # Compute loss
         loss, loss_breakdown = self.loss(
@@ -137,22 +246,27 @@ class OpenFoldWrapper(pl.LightningModule):
         return loss
 
     def on_before_zero_grad(self, *args, **kwargs):
-        self.ema.update(self.model)
+        if(self.global_step % self.ema.update_every == 0):
+            self.ema.update(self.model)
+
+    def swap_ema_weights(self):
+        """
+        Context manager that temporarily puts the EMA weights into the 
+        model's parameters. See ExponentialMovingAverage.swapped_into.
+        """
+        return self.ema.swapped_into(self.model)
 
     def validation_step(self, batch, batch_idx):
         self.loss.mode = 'val' if self.phase != 'test' else 'test'
-        # At the start of validation, load the EMA weights
-        if(self.cached_weights is None):
-            # model.state_dict() contains references to model weights rather
-            # than copies. Therefore, we need to clone them before calling 
-            # load_state_dict().
-            clone_param = lambda t: t.detach().clone()
-            self.cached_weights = tensor_tree_map(clone_param, self.model.state_dict())
-            self.model.load_state_dict(self.ema.state_dict()["params"])
-       
+
+        # At the start of validation, swap in the EMA weights
+        if(self._ema_swap is None):
+            self._ema_swap = ExitStack()
+            self._ema_swap.enter_context(self.swap_ema_weights())
+
         # Run the model
         outputs = self(batch)
-        batch = tensor_tree_map(lambda t: t[..., -1], batch)
+        batch = _remove_recycling_dim(batch)
 
         # Compute loss and other metrics
         batch["use_clamped_fape"] = 0.
@@ -165,8 +279,9 @@ class OpenFoldWrapper(pl.LightningModule):
 
     def validation_epoch_end(self, _):
         # Restore the model weights to normal
-        self.model.load_state_dict(self.cached_weights)
-        self.cached_weights = None
+        if(self._ema_swap is not None):
+            self._ema_swap.close()
+            self._ema_swap = None
 
     def _compute_validation_metrics(self, 
         batch, 
@@ -179,12 +294,11 @@ class OpenFoldWrapper(pl.LightningModule):
         pred_coords = outputs["final_atom_positions"]
         all_atom_mask = batch["all_atom_mask"]
     
-        # This is super janky for superimposition. Fix later
-        gt_coords_masked = gt_coords * all_atom_mask[..., None]
-        pred_coords_masked = pred_coords * all_atom_mask[..., None]
+        # Every metric below takes the mask into account, so the coordinates
+        # don't need to be zeroed out at masked positions first
         ca_pos = residue_constants.atom_order["CA"]
-        gt_coords_masked_ca = gt_coords_masked[..., ca_pos, :]
-        pred_coords_masked_ca = pred_coords_masked[..., ca_pos, :]
+        gt_coords_ca = gt_coords[..., ca_pos, :]
+        pred_coords_ca = pred_coords[..., ca_pos, :]
         all_atom_mask_ca = all_atom_mask[..., ca_pos]
     
         lddt_ca_score = lddt_ca(
@@ -198,8 +312,8 @@ class OpenFoldWrapper(pl.LightningModule):
         metrics["lddt_ca"] = lddt_ca_score
    
         drmsd_ca_score = drmsd(
-            pred_coords_masked_ca,
-            gt_coords_masked_ca,
+            pred_coords_ca,
+            gt_coords_ca,
             mask=all_atom_mask_ca, # still required here to compute n
         )
    
@@ -208,13 +322,13 @@ class OpenFoldWrapper(pl.LightningModule):
         if(superimposition_metrics):
             try:
                 superimposed_pred, alignment_rmsd = superimpose(
-                    gt_coords_masked_ca, pred_coords_masked_ca, all_atom_mask_ca,
+                    gt_coords_ca, pred_coords_ca, all_atom_mask_ca,
                 )
                 gdt_ts_score = gdt_ts(
-                    superimposed_pred, gt_coords_masked_ca, all_atom_mask_ca
+                    superimposed_pred, gt_coords_ca, all_atom_mask_ca
                 )
                 gdt_ha_score = gdt_ha(
-                    superimposed_pred, gt_coords_masked_ca, all_atom_mask_ca
+                    superimposed_pred, gt_coords_ca, all_atom_mask_ca
                 )
 
                 metrics["rmsd_ca"] = alignment_rmsd
@@ -226,46 +340,42 @@ class OpenFoldWrapper(pl.LightningModule):
 
                 # Record various structure metrics, only supports batch size = 1
                 if gt_coords.shape[0] == 1:
-                    # Create our superimposed and de-padded all-atom variables for analysis
-                    flat_gt = gt_coords_masked.reshape(gt_coords.shape[0], -1, 3)
-                    flat_pred = pred_coords_masked.reshape(pred_coords.shape[0], -1, 3)
+                    # Create our flattened and de-padded all-atom variables for analysis
+                    flat_gt = gt_coords.reshape(gt_coords.shape[0], -1, 3)
+                    flat_pred = pred_coords.reshape(pred_coords.shape[0], -1, 3)
                     flat_all_atom_mask = all_atom_mask.reshape(all_atom_mask.shape[0], -1)
+                    mask_flat = flat_all_atom_mask.reshape(-1).bool()
 
-                    flat_gt_unpadded = flat_gt[flat_all_atom_mask.bool()]
-                    flat_pred_unpadded = flat_pred[flat_all_atom_mask.bool()]
-                    flat_gt_unpadded_np = flat_gt_unpadded.cpu().numpy()
+                    gt_unpadded = flat_gt.reshape(-1, 3)[mask_flat]
+                    pred_unpadded = flat_pred.reshape(-1, 3)[mask_flat]
 
                     # >>> All-atom RMSD
                     flat_superimposed_pred_aa, rmsd_all = superimpose(
                         flat_gt, flat_pred, flat_all_atom_mask)
                     metrics["rmsd_aa"] = rmsd_all
-                    flat_superimposed_pred_aa_unpadded_np = flat_superimposed_pred_aa[
-                        flat_all_atom_mask.bool()].cpu().numpy()
 
                     # >>> Global Metrics (GDC_all, TM score)
-                    gdcall_aa = scn_losses.gdc_all(flat_gt_unpadded_np,
-                                                flat_superimposed_pred_aa_unpadded_np,
-                                                skip_alignment=True,
-                                                as_percent=False)
-                    tmscore_aa = scn_losses.tm_score(
-                        flat_gt_unpadded_np,
-                        flat_superimposed_pred_aa_unpadded_np,
-                        skip_alignment=True)
-                    tmscore_ca = scn_losses.tm_score(
-                        gt_coords_masked_ca[all_atom_mask_ca.bool()].cpu().numpy(),
-                        superimposed_pred[all_atom_mask_ca.bool()].cpu().numpy(),
-                        skip_alignment=True)
+                    gdcall_aa = gdc_all(
+                        flat_superimposed_pred_aa, flat_gt, flat_all_atom_mask)
+                    tmscore_aa = tm_score(
+                        flat_superimposed_pred_aa, flat_gt, flat_all_atom_mask)
+                    tmscore_ca = tm_score(
+                        superimposed_pred, gt_coords_ca, all_atom_mask_ca)
 
                     # >>> Local Metrics (DRMSD, LDDT, no alignment required)
-                    # Note: Current implementation of lddt all-atom in OpenFold does not
-                    # exclude atoms within the same residue. Use SidechainNet impl. instead.
-                    drmsd_aa = scn_losses.drmsd(flat_gt_unpadded, flat_pred_unpadded)
-                    lddt_aa = scn_losses.lddt_all(
-                        flat_gt.reshape(-1, 3) * all_atom_mask.reshape(-1, 1),
-                        flat_pred.reshape(-1, 3) * all_atom_mask.reshape(-1, 1),
-                        atom_mask=all_atom_mask.reshape(-1).bool(),
-                        residue_shape=gt_coords.shape[-1],
-                        cutoff=15)
+                    # Note: lddt_ca above uses the OpenFold lddt, which does not
+                    # exclude atoms within the same residue. lddt_all does.
+                    atoms_per_residue = gt_coords.shape[-2]
+                    residue_index = torch.arange(
+                        mask_flat.shape[-1], device=mask_flat.device
+                    ) // atoms_per_residue
+                    residue_index = residue_index[mask_flat]
+                    drmsd_aa = drmsd_all(pred_unpadded, gt_unpadded)
+                    lddt_aa = lddt_all(
+                        pred_unpadded,
+                        gt_unpadded,
+                        residue_index,
+                        cutoff=15.)
 
                     metrics["gdcall_aa"] = gdcall_aa
                     metrics["tmscore_aa"] = tmscore_aa
@@ -314,14 +424,17 @@ class OpenFoldWrapper(pl.LightningModule):
     def on_load_checkpoint(self, checkpoint):
         ema = checkpoint["ema"]
         if(not self.model.template_config.enabled):
-            ema["params"] = {k:v for k,v in ema["params"].items() if not "template" in k}
+            for k in [k for k in ema["params"] if "template" in k]:
+                ema["params"].pop(k)
+        # Restores onto self.ema.device, which on_fit_start has already set
+        # if the module has been placed
         self.ema.load_state_dict(ema)
 
     def on_save_checkpoint(self, checkpoint):
         checkpoint["ema"] = self.ema.state_dict()
 
     def resume_last_lr_step(self, lr_step):
-        self.last_lr_step = lr_step
+        self.last_lr_step = int(lr_step)
         # Load the openmm scheduler step, if used
         if self.openmm_scheduler is None:
             return
@@ -346,6 +459,9 @@ def update_openmm_config(config, args):
     """Update training config in-place with OpenMM-Loss training arguments."""
     config.loss.openmm.use_openmm = args.use_openmm
     config.loss.openmm.add_struct_metrics = args.add_struct_metrics
+    config.loss.openmm.struct_metrics_every_n_train_steps = (
+        args.struct_metrics_every_n_train_steps
+    )
     config.loss.openmm.weight = args.openmm_weight
     config.loss.openmm.write_pdbs_every_n_steps = args.write_pdbs_every_n_steps
     config.loss.openmm.pdb_dir = os.path.join(args.output_dir, "pdbs")
@@ -368,7 +484,31 @@ def main(args):
     # Update config with user-specified arguments for OpenMM-Loss
     update_openmm_config(config, args)
 
-    model_module = OpenFoldWrapper(config, args.wandb, args.log_other_metrics_on_step)
+    # Write PDBs in the background so that disk I/O overlaps with training
+    pdb_executor = None
+    if(config.loss.openmm.write_pdbs_every_n_steps != -1):
+        pdb_executor = ThreadPoolExecutor(max_workers=2)
+        # Only the first process on each node touches the filesystem here, 
+        # since pdb_dir need not be shared between nodes. The process group 
+        # rendezvous in trainer.fit() orders this before any rank writes a 
+        # PDB.
+        local_rank = int(
+            os.environ.get("LOCAL_RANK", os.environ.get("SLURM_LOCALID", 0))
+        )
+        if(local_rank == 0):
+            for mode in ["train", "val", "test"]:
+                for kind in ["true", "pred"]:
+                    os.makedirs(
+                        os.path.join(config.loss.openmm.pdb_dir, mode, kind),
+                        exist_ok=True,
+                    )
+
+    model_module = OpenFoldWrapper(
+        config, 
+        args.wandb, 
+        args.log_other_metrics_on_step,
+        pdb_executor=pdb_executor,
+    )
     if(args.resume_from_ckpt and "finetuning_" in args.resume_from_ckpt):
         logging.info("Loading weights from OpenFold checkpoint...")
         sd = torch.load(args.resume_from_ckpt)
@@ -380,11 +520,17 @@ def main(args):
         logging.info("Successfully loaded model weights...")
     elif(args.resume_from_ckpt and not args.resume_model_weights_only):
         if(os.path.isdir(args.resume_from_ckpt)):  
-            last_global_step = get_global_step_from_zero_checkpoint(args.resume_from_ckpt)
+            last_global_step = int(
+                get_global_step_from_zero_checkpoint(args.resume_from_ckpt)
+            )
         else:
-            sd = torch.load(args.resume_from_ckpt)
+            # Only the step count is needed here, so keep everything on the CPU
+            sd = torch.load(args.resume_from_ckpt, map_location="cpu")
             try:
-                last_global_step = int(sd['global_step'])
+                global_step = sd['global_step']
+                if(torch.is_tensor(global_step)):
+                    global_step = global_step.item()
+                last_global_step = int(global_step)
             except KeyError:
                 last_global_step = 0
         model_module.resume_last_lr_step(last_global_step)
@@ -404,6 +550,7 @@ def main(args):
     # TorchScript components of the model
     if(args.script_modules):
         script_preset_(model_module)
+        script_validation_metrics_()
 
     #data_module = DummyDataLoader("new_batch.pickle")
     data_module = OpenFoldDataModule(
@@ -466,7 +613,7 @@ def main(args):
         strategy = DeepSpeedPlugin(
             config=args.deepspeed_config_path,
         )
-        if(args.wandb):
+        if(args.wandb and rank_zero_only.rank == 0):
             wdb_logger.experiment.save(args.deepspeed_config_path)
             wdb_logger.experiment.save("openfold/config.py")
     elif (args.gpus is not None and args.gpus > 1) or args.num_nodes > 1:
@@ -474,9 +621,13 @@ def main(args):
     else:
         strategy = None
  
-    if(args.wandb):
+    if(args.wandb and rank_zero_only.rank == 0):
         freeze_path = f"{wdb_logger.experiment.dir}/package_versions.txt"
-        os.system(f"{sys.executable} -m pip freeze > {freeze_path}")
+        with open(freeze_path, "w") as fp:
+            fp.writelines(
+                f"{d.metadata['Name']}=={d.version}\n" 
+                for d in importlib.metadata.distributions()
+            )
         wdb_logger.experiment.save(f"{freeze_path}")
 
     trainer = pl.Trainer.from_argparse_args(
@@ -492,11 +643,15 @@ def main(args):
     else:
         ckpt_path = args.resume_from_ckpt
 
-    trainer.fit(
-        model_module, 
-        datamodule=data_module,
-        ckpt_path=ckpt_path,
-    )
+    try:
+        trainer.fit(
+            model_module, 
+            datamodule=data_module,
+            ckpt_path=ckpt_path,
+        )
+    finally:
+        if(pdb_executor is not None):
+            pdb_executor.shutdown(wait=True)
 
 
 def bool_type(bool_str: str):
@@ -697,6 +852,11 @@ if __name__ == "__main__":
         "--add_struct_metrics", type=bool_type, default=True, help="Whether to add "
         "additional structure metrics to wandb including RMSD, GDC, DRMSD, LDDT, etc."
     )
+    omm_loss.add_argument(
+        "--struct_metrics_every_n_train_steps", type=int, default=0, help="Frequency "
+        "with which to compute the additional structure metrics on training batches. "
+        "0 computes them during validation only."
+    )
     omm_loss.add_argument(
         "--write_pdbs_every_n_steps", type=int, default=-1, help="Frequency with which to"
         " write pdbs of the predicted structures.")